@@ -3,7 +3,6 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #   "psutil",
-#   "jinija2",
 #   "requests"
 # ]
 # ///
@@ -20,7 +19,6 @@ Generate a simple, attractive HTML status page showing:
 Requires:
 - Python 3.6+ (3.12+ recommended)
 - psutil
-- jinja2
 - requests
 
 Usage:
@@ -29,11 +27,28 @@ Usage:
 
 import os
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import html
+import json
 import sqlite3
 import psutil
 import requests
 from datetime import datetime, timedelta
-from jinja2 import Environment
+
+
+# SQL used on every account's store database, hoisted so the sqlite3
+# statement cache always sees the identical string objects.
+_SQL_ACCOUNT_COUNT = "SELECT COUNT(*) FROM account"
+_SQL_ACCOUNT_DIDS = "SELECT did FROM account"
+_SQL_STORE_COUNTS = (
+    "SELECT (SELECT COUNT(*) FROM record), (SELECT COUNT(*) FROM blob)"
+)
+_SQL_STORE_COUNTS_WITH_SIZE = (
+    "SELECT (SELECT COUNT(*) FROM record), (SELECT COUNT(*) FROM blob),"
+    " (SELECT COALESCE(SUM(size), 0) FROM blob)"
+)
 
 
 def parse_env_file(file_path):
@@ -55,19 +70,27 @@ def parse_env_file(file_path):
     return env_vars
 
 
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+
+
+@functools.lru_cache(maxsize=1024)
 def human_readable_size(size, decimal_places=1):
     """Convert a size in bytes to a human-readable string."""
-    for unit in ["B", "KB", "MB", "GB", "TB", "PB"]:
-        if size < 1024.0 or unit == "PB":
-            return f"{size:.{decimal_places}f} {unit}"
-        size /= 1024.0
-    return f"{size:.{decimal_places}f} PB"
+    # bit_length() picks the unit directly: each unit step is 10 bits,
+    # so one shift replaces the loop of floating-point divisions.
+    if size <= 0:
+        return f"{0:.{decimal_places}f} B"
+    index = min((int(size).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * index)):.{decimal_places}f} {_SIZE_UNITS[index]}"
 
 
 def get_system_metrics(pds_path="/pds"):
     """Gather system load, CPU usage, /pds-disk stats, memory, kernel, and network usage."""
     load1, load5, load15 = os.getloadavg()
-    cpu_percent = psutil.cpu_percent(interval=1)
+    # Non-blocking: reports usage since the priming call at the top of
+    # main(), so the sampling window overlaps the account scanning
+    # instead of sleeping for a second here.
+    cpu_percent = psutil.cpu_percent(interval=None)
     # Use /pds (or provided path) for disk usage
     usage = psutil.disk_usage("/")
     net = psutil.net_io_counters(pernic=True).get("eth0")
@@ -117,70 +140,271 @@ def get_pds_version(host="localhost", port=3000):
     return "Unable to retrieve"
 
 
-def get_account_data(pds_path):
-    """Get total account count and list of DIDs from the account database."""
-    account_db = os.path.join(pds_path, "account.sqlite")
-    uri = f"file:{account_db}?mode=ro"
+@contextlib.contextmanager
+def open_readonly_db(db_path):
+    """Open a SQLite database read-only with snapshot-friendly pragmas.
 
-    conn = sqlite3.connect(uri, uri=True)
-    cur = conn.cursor()
+    The script is a one-shot reader, so exclusive locking is safe and
+    skips the per-read fcntl lock acquire/release; mmap serves pages
+    straight from the page cache without read syscalls.
 
-    cur.execute("SELECT COUNT(*) FROM account")
-    total_accounts = cur.fetchone()[0]
+    Yields the connection and guarantees it is closed on exit, even
+    when a query raises, so the number of open connections is bounded
+    by the number of scan workers rather than left to garbage
+    collection.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, cached_statements=32)
+    try:
+        conn.execute("PRAGMA query_only=1")
+        conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+        conn.execute("PRAGMA mmap_size=67108864")
+        conn.execute("PRAGMA cache_size=-8192")
+        yield conn
+    finally:
+        conn.close()
 
-    cur.execute("SELECT did FROM account")
-    dids = [row[0] for row in cur.fetchall()]
 
-    conn.close()
-    return total_accounts, dids
+def get_account_data(pds_path):
+    """Get total account count and list of DIDs from the account database."""
+    account_db = os.path.join(pds_path, "account.sqlite")
 
+    with open_readonly_db(account_db) as conn:
+        cur = conn.cursor()
 
-def find_store_db(pds_path, did):
-    """Find the store.sqlite file for a given DID."""
-    actors_root = os.path.join(pds_path, "actors")
-    for root, dirs, files in os.walk(actors_root):
-        if os.path.basename(root) == did and "store.sqlite" in files:
-            return os.path.join(root, "store.sqlite")
-    return None
+        cur.execute(_SQL_ACCOUNT_COUNT)
+        total_accounts = cur.fetchone()[0]
 
+        cur.execute(_SQL_ACCOUNT_DIDS)
+        dids = [row[0] for row in cur.fetchall()]
 
-def get_store_data(pds_path, did):
-    """Get record and blob counts from a store database."""
-    store_db = find_store_db(pds_path, did)
-    if not store_db:
-        raise FileNotFoundError(f"store.sqlite not found for DID {did}")
+    return total_accounts, dids
 
-    uri = f"file:{store_db}?mode=ro"
-    conn = sqlite3.connect(uri, uri=True)
-    cur = conn.cursor()
 
-    cur.execute("SELECT COUNT(*) FROM record")
-    rec_count = cur.fetchone()[0]
+def build_store_index(pds_path):
+    """Walk the actors tree once and map each DID to its store.sqlite path."""
+    # One scandir pass instead of one full walk per DID, so filesystem
+    # traversal cost stays linear in the number of actor directories.
+    index = {}
+    stack = [os.path.join(pds_path, "actors")]
+    sep = os.sep
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                # Plain concatenation instead of os.path.join: scandir
+                # paths never carry a trailing separator, so this is
+                # equivalent and skips join's per-child separator checks.
+                store_db = entry.path + sep + "store.sqlite"
+                if os.path.exists(store_db):
+                    index[entry.name] = store_db
+                else:
+                    stack.append(entry.path)
+    return index
+
+
+def get_store_data(store_db):
+    """Get record count, blob count, and blob bytes from a store database.
+
+    Summing the blob table's size column replaces walking the blocks
+    directory: one B-tree traversal instead of a stat per blob file.
+    blob_bytes is None when the schema has no size column, in which
+    case the caller falls back to the filesystem walk.
+    """
+    with open_readonly_db(store_db) as conn:
+        cur = conn.cursor()
+
+        # All three values in a single statement so the small
+        # per-account databases cost one query round trip.
+        try:
+            cur.execute(_SQL_STORE_COUNTS_WITH_SIZE)
+            rec_count, blob_count, blob_bytes = cur.fetchone()
+        except sqlite3.OperationalError:
+            cur.execute(_SQL_STORE_COUNTS)
+            rec_count, blob_count = cur.fetchone()
+            blob_bytes = None
+
+    return rec_count, blob_count, blob_bytes
+
+
+def sum_tree_usage(path):
+    """Sum file sizes under a directory with a serial scandir walk."""
+    # Iterative scandir instead of os.walk + getsize: the DirEntry stat
+    # is cached from the directory read, so each file costs at most one
+    # stat syscall instead of two. Locals are bound outside the loop to
+    # cut attribute lookups per entry; this is the hottest Python-level
+    # loop in the script. (A JIT would not help here: the work is
+    # syscalls, and compile time would dominate a one-shot run.)
+    total = 0
+    stack = [path]
+    scandir = os.scandir
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        try:
+            entries = scandir(pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        push(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    return total
 
-    cur.execute("SELECT COUNT(*) FROM blob")
-    blob_count = cur.fetchone()[0]
 
-    conn.close()
-    return rec_count, blob_count
+# Shared pool for subtree sizing: get_directory_usage also runs inside
+# the per-DID scan workers, so a pool per call would multiply walker
+# threads (scan workers x subtree workers) against one disk queue. One
+# bounded pool caps total walker concurrency at 8 no matter how many
+# scans are in flight.
+_sizing_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
 
 def get_directory_usage(path):
     """Calculate total disk usage of a directory."""
+    # Split the top level once: files are summed here, subtrees are
+    # walked concurrently. getdents/stat release the GIL, so a few
+    # threads keep the disk queue busy; the cap avoids thrashing HDDs.
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return 0
+
     total = 0
-    for root, _, files in os.walk(path):
-        for fn in files:
-            fp = os.path.join(root, fn)
+    subdirs = []
+    with entries:
+        for entry in entries:
             try:
-                total += os.path.getsize(fp)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
             except OSError:
                 pass
+
+    if len(subdirs) > 1:
+        total += sum(_sizing_executor.map(sum_tree_usage, subdirs))
+    elif subdirs:
+        total += sum_tree_usage(subdirs[0])
     return total
 
 
-def get_template():
-    """Create and return a Jinja2 template for the status page."""
-    template_str = """
-<!DOCTYPE html>
+def get_block_dir_usage(block_dir, blobstore_dev):
+    """Get the disk usage of a blocks directory, cheaply if possible.
+
+    If the directory is its own mountpoint (different device than the
+    blobstore directory directly above it), a single statvfs call
+    reports the used bytes of the whole filesystem; that approximates
+    the directory size but avoids walking millions of blob files.
+    Directories sharing the blobstore's filesystem — including the
+    common case where the blobstore itself is the dedicated mount —
+    fall back to the full walk.
+    """
+    try:
+        if os.stat(block_dir).st_dev != blobstore_dev:
+            vfs = os.statvfs(block_dir)
+            return (vfs.f_blocks - vfs.f_bfree) * vfs.f_frsize
+    except OSError:
+        pass
+    return get_directory_usage(block_dir)
+
+
+def load_cache(cache_path):
+    """Load the per-DID result cache, tolerating a missing or bad file."""
+    if not cache_path:
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    # Drop malformed entries so a damaged cache degrades to a rescan
+    # of those DIDs instead of crashing the run
+    return {k: v for k, v in cache.items() if isinstance(v, dict)}
+
+
+def save_cache(cache_path, cache):
+    """Write the per-DID result cache; failures only cost the cache."""
+    try:
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+
+def process_did(store_db, blobstore_path, blobstore_dev, did, cached=None):
+    """Gather store counts and blocks-dir usage for a single DID.
+
+    Returns the usage row plus a cache entry (or None when the result
+    should not be cached). When the cached entry's blocks-dir and
+    store.sqlite mtimes are unchanged, the expensive walk and queries
+    are skipped entirely. The blocks-dir check uses the top-level
+    mtime, so a blob added to an existing shard subdirectory is only
+    picked up once the store database changes too.
+    """
+    block_dir = os.path.join(blobstore_path, did)
+    block_mtime = store_mtime = None
+    try:
+        block_mtime = os.stat(block_dir).st_mtime_ns
+    except OSError:
+        pass
+    if store_db:
+        try:
+            store_mtime = os.stat(store_db).st_mtime_ns
+        except OSError:
+            pass
+
+    if (
+        isinstance(cached, dict)
+        and store_mtime is not None
+        and cached.get("store_mtime") == store_mtime
+        and cached.get("block_mtime") == block_mtime
+        and all(k in cached for k in ("rec", "blob", "size"))
+    ):
+        return (did, cached["rec"], cached["blob"], cached["size"]), cached
+
+    try:
+        if not store_db:
+            raise FileNotFoundError(f"store.sqlite not found for DID {did}")
+        rec_count, blob_count, blob_bytes = get_store_data(store_db)
+    except Exception:
+        rec_count, blob_count, blob_bytes = "Error", "Error", None
+
+    if blob_bytes is not None:
+        size = blob_bytes
+    elif block_mtime is not None:
+        size = get_block_dir_usage(block_dir, blobstore_dev)
+    else:
+        size = 0
+
+    entry = None
+    if store_mtime is not None and rec_count != "Error":
+        entry = {
+            "block_mtime": block_mtime,
+            "store_mtime": store_mtime,
+            "rec": rec_count,
+            "blob": blob_count,
+            "size": size,
+        }
+    return (did, rec_count, blob_count, size), entry
+
+
+# The page layout is almost entirely static: only the metrics cells
+# and the per-account rows vary. Keeping the static parts as constants
+# and the dynamic parts as format strings makes a render one _HEAD
+# write, one _METRICS_FMT format, N _ROW formats, and one _TAIL write.
+_HEAD = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -196,7 +420,9 @@ def get_template():
 <body class="bg-dark text-light">
     <div class="container">
         <h1 class="my-4">Server Status</h1>
-        <p>Report generated: {{ generated }} (uptime: {{ metrics.uptime }}, kernel: {{ metrics.kernel_version }})</p>
+"""
+
+_METRICS_FMT = """        <p>Report generated: {generated} (uptime: {uptime}, kernel: {kernel_version})</p>
 
         <h2>System Metrics</h2>
         <table class="table table-dark table-bordered">
@@ -209,49 +435,81 @@ def get_template():
                 <th>Disk Free</th>
             </tr>
             <tr>
-                <td>{{ "%.2f"|format(metrics.load1) }} / {{ "%.2f"|format(metrics.load5) }} / {{ "%.2f"|format(metrics.load15) }}</td>
-                <td>{{ "%.1f"|format(metrics.cpu_percent) }}%</td>
-                <td>{{ human_size(metrics.mem_used) }} / {{ human_size(metrics.mem_total) }}</td>
-                <td>{{ human_size(metrics.net_sent) }} / {{ human_size(metrics.net_recv) }}</td>
-                <td>{{ human_size(metrics.disk_used) }}</td>
-                <td>{{ human_size(metrics.disk_free) }}</td>
+                <td>{load1:.2f} / {load5:.2f} / {load15:.2f}</td>
+                <td>{cpu_percent:.1f}%</td>
+                <td>{mem_used} / {mem_total}</td>
+                <td>{net_sent} / {net_recv}</td>
+                <td>{disk_used}</td>
+                <td>{disk_free}</td>
             </tr>
         </table>
 
-        <h2>Accounts in {{ pds_path }}</h2>
-        <p>Total accounts: {{ total_accounts }} (PDS Version: {{ pds_version }})</p>
+        <h2>Accounts in {pds_path}</h2>
+        <p>Total accounts: {total_accounts} (PDS Version: {pds_version})</p>
         <table class="table table-dark table-striped table-bordered">
             <thead>
                 <tr>
                     <th>DID</th>
                     <th>Record Count</th>
                     <th>Blob Count</th>
-                    <th>Blocks Dir Size</th>
+                    <th>Blob Bytes</th>
                 </tr>
             </thead>
             <tbody>
-                {% for did, rec, blob, size in usage_list %}
-                <tr>
-                    <td>{{ did }}</td>
-                    <td>{{ rec }}</td>
-                    <td>{{ blob }}</td>
-                    <td>{{ human_size(size) }}</td>
+"""
+
+_ROW = """                <tr>
+                    <td>{did}</td>
+                    <td>{rec}</td>
+                    <td>{blob}</td>
+                    <td>{size}</td>
                 </tr>
-                {% endfor %}
-            </tbody>
+"""
+
+_TAIL = """            </tbody>
         </table>
     </div>
 </body>
 </html>
 """
-    # Create an environment with autoescape enabled
-    env = Environment(autoescape=True)
 
-    # Register the human_readable_size function as a filter for templates
-    env.filters["human_size"] = human_readable_size
 
-    # Create and return the template from the string
-    return env.from_string(template_str)
+def write_status_page(f, metrics, generated, total_accounts, usage_list,
+                      pds_path, pds_version):
+    """Write the status page HTML directly to an open file.
+
+    Plain format strings with html.escape instead of a template engine:
+    account rows stream straight to the file, so no intermediate list
+    of row strings or multi-megabyte joined page is ever built.
+    """
+    human_size = human_readable_size
+    f.write(_HEAD)
+    f.write(_METRICS_FMT.format(
+        generated=html.escape(generated),
+        uptime=html.escape(metrics["uptime"]),
+        kernel_version=html.escape(metrics["kernel_version"]),
+        load1=metrics["load1"],
+        load5=metrics["load5"],
+        load15=metrics["load15"],
+        cpu_percent=metrics["cpu_percent"],
+        mem_used=human_size(metrics["mem_used"]),
+        mem_total=human_size(metrics["mem_total"]),
+        net_sent=human_size(metrics["net_sent"]),
+        net_recv=human_size(metrics["net_recv"]),
+        disk_used=human_size(metrics["disk_used"]),
+        disk_free=human_size(metrics["disk_free"]),
+        pds_path=html.escape(pds_path),
+        total_accounts=total_accounts,
+        pds_version=html.escape(str(pds_version)),
+    ))
+    for did, rec, blob, size in usage_list:
+        f.write(_ROW.format(
+            did=html.escape(did),
+            rec=rec,
+            blob=blob,
+            size=human_size(size),
+        ))
+    f.write(_TAIL)
 
 
 def main():
@@ -268,8 +526,19 @@ def main():
     parser.add_argument(
         "--pds-port", default=3000, type=int, help="PDS port for version check"
     )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="Path to a JSON result cache (e.g. /var/cache/pds-status.json); "
+        "accounts whose blocks dir and store database are unchanged since "
+        "the last run are not re-scanned",
+    )
     args = parser.parse_args()
 
+    # Prime the CPU sampler; get_system_metrics reads the delta after
+    # the account scanning, so the window costs no wall time.
+    psutil.cpu_percent(interval=None)
+
     # Parse PDS configuration if provided
     if args.pds_config:
         _config = parse_env_file(args.pds_config)
@@ -277,29 +546,59 @@ def main():
         pds_blobstore_disk_location = _config["PDS_BLOBSTORE_DISK_LOCATION"]
     else:
         pds_data_directory = "/pds"
-        pds_blobstore_disk_location = os.path.join(args.pds_path, "blocks")
+        pds_blobstore_disk_location = os.path.join(pds_data_directory, "blocks")
 
     # Gather all data
-    metrics = get_system_metrics(pds_data_directory)
     total_accounts, dids = get_account_data(pds_data_directory)
+    store_index = build_store_index(pds_data_directory)
+    # Device of the blobstore directory itself: a per-DID dir only
+    # counts as its own mount if it differs from this, so a dedicated
+    # blobstore mount doesn't make every account look like one.
+    try:
+        blobstore_dev = os.stat(pds_blobstore_disk_location).st_dev
+    except OSError:
+        blobstore_dev = os.stat(pds_data_directory).st_dev
+
+    # Per-DID scanning is I/O-bound (scandir + SQLite page reads), so
+    # accounts can be processed concurrently. Each worker opens its own
+    # SQLite connection since connections are not thread-safe.
+    cache = load_cache(args.cache)
+    new_cache = {}
     usage_list = []
-
-    for did in dids:
-        try:
-            rec_count, blob_count = get_store_data(pds_data_directory, did)
-        except Exception:
-            rec_count, blob_count = "Error", "Error"
-
-        block_dir = os.path.join(pds_blobstore_disk_location, did)
-        size = get_directory_usage(block_dir) if os.path.isdir(block_dir) else 0
-        usage_list.append((did, rec_count, blob_count, size))
-
-    # Sort usage_list by record count in descending order
+    if dids:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, len(dids))
+        ) as executor:
+            futures = [
+                executor.submit(
+                    process_did,
+                    store_index.get(did),
+                    pds_blobstore_disk_location,
+                    blobstore_dev,
+                    did,
+                    cache.get(did),
+                )
+                for did in dids
+            ]
+            for f in concurrent.futures.as_completed(futures):
+                row, entry = f.result()
+                usage_list.append(row)
+                if entry is not None:
+                    new_cache[row[0]] = entry
+
+    if args.cache:
+        save_cache(args.cache, new_cache)
+
+    # Sort usage_list by record count in descending order, with DID as
+    # the tiebreaker: results arrive in thread-completion order, so
+    # without it tied rows would shuffle between runs
     # Convert string 'Error' to -1 for sorting purposes
+    usage_list.sort(key=lambda x: x[0])
     usage_list.sort(key=lambda x: -1 if x[1] == "Error" else int(x[1]), reverse=True)
 
-    # Get the template
-    template = get_template()
+    # Sample system metrics after the scan so the CPU measurement
+    # window spans the work done above
+    metrics = get_system_metrics(pds_data_directory)
 
     # Get timestamp with timezone
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S %Z")
@@ -310,20 +609,19 @@ def main():
     # Get PDS version
     pds_version = get_pds_version(args.pds_host, args.pds_port)
 
-    # Render the template with our data
-    rendered_html = template.render(
-        metrics=metrics,
-        generated=timestamp,
-        total_accounts=total_accounts,
-        usage_list=usage_list,
-        pds_path=pds_data_directory,
-        human_size=human_readable_size,
-        pds_version=pds_version,
-    )
-
-    # Write output to file
-    with open(args.output, "w") as f:
-        f.write(rendered_html)
+    # Stream the page straight to the output file; the 1 MiB buffer
+    # keeps most pages to a single write syscall while capping memory
+    # for very large account tables.
+    with open(args.output, "w", encoding="utf-8", buffering=1 << 20) as f:
+        write_status_page(
+            f,
+            metrics=metrics,
+            generated=timestamp,
+            total_accounts=total_accounts,
+            usage_list=usage_list,
+            pds_path=pds_data_directory,
+            pds_version=pds_version,
+        )
 
     print(f"Status page written to {args.output}")
 